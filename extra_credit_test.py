@@ -205,6 +205,130 @@ def testMultipleTournament():
 
     print "5. Database can support multiple tournaments."
 
+def executeQuery(query, params=()):
+    """Runs a query directly against the database and returns the fetched rows, if any."""
+    conn, cur = connect()
+    cur.execute(query, params)
+    result = cur.fetchall() if cur.description else None
+    conn.commit()
+    cur.close()
+    conn.close()
+    return result
+
+def cachedPairings(tournament_id=0):
+    """Returns the stored pairings of a tournament, or None if they are not valid."""
+    [(valid,)] = executeQuery(
+        "SELECT cached_version = version FROM pairing_state WHERE tournament_id = %s;",
+        (tournament_id,))
+    if not valid:
+        return None
+    return executeQuery(
+        "SELECT player_id_1, player_name_1, player_id_2, player_name_2 FROM pairing_cache "
+        "WHERE tournament_id = %s ORDER BY seq;", (tournament_id,))
+
+def testPrecomputedPairings():
+    deleteMatches()
+    deletePlayers()
+    registerPlayer("Bruno Walton")
+    registerPlayer("Boots O'Neal")
+    registerPlayer("Cathy Burton")
+    registerPlayer("Diane Grant")
+    standings = playerStandings()
+    [id1, id2, id3, id4] = [row[0] for row in standings]
+
+    if reportMatch(id1, id2) is not None or isRoundComplete():
+        raise ValueError("Round should not be complete until every player has played.")
+
+    worker = reportMatch(id3, id4)
+    if worker is None or not isRoundComplete():
+        raise ValueError("Round should be complete when every player has played the same number of matches.")
+    worker.join()
+
+    cached = cachedPairings()
+    if cached is None:
+        raise ValueError("Pairings should be precomputed when a round is complete.")
+    computed = executeQuery(
+        "SELECT player_id_1, player_name_1, player_id_2, player_name_2 FROM swiss_pair WHERE tournament_id = 0;")
+    if sorted(cached) != sorted(computed):
+        raise ValueError("Precomputed pairings should be the same as computed pairings.")
+
+    # Mark the stored pairings to tell them apart from the ones computed by the view
+    executeQuery("UPDATE pairing_cache SET player_name_1 = 'Cached' WHERE tournament_id = 0 AND seq = 0;")
+    if swissPairings()[0][1] != 'Cached':
+        raise ValueError("swissPairings() should return the precomputed pairings.")
+
+    # Late correction: id4 actually beat id3
+    executeQuery("UPDATE match SET winner = player_id_2 "
+                 "WHERE tournament_id = 0 AND player_id_1 = %s AND player_id_2 = %s;", (id3, id4))
+    if cachedPairings() is not None:
+        raise ValueError("Correcting a match should invalidate precomputed pairings.")
+    pairings = swissPairings()
+    if 'Cached' in [row[1] for row in pairings] or set([id1, id4]) not in [set([row[0], row[2]]) for row in pairings]:
+        raise ValueError("Pairings should be computed again after a match is corrected.")
+
+    # Removing a match also invalidates them
+    if not precomputePairings() or cachedPairings() is None:
+        raise ValueError("Pairings should be stored when nothing changed while computing them.")
+    executeQuery("DELETE FROM match WHERE tournament_id = 0 AND player_id_1 = %s AND player_id_2 = %s;", (id1, id2))
+    if cachedPairings() is not None:
+        raise ValueError("Deleting a match should invalidate precomputed pairings.")
+
+    print "6. Pairings are precomputed when a round is complete and invalidated by corrections."
+
+def testPlayerSearchAndDeduplication():
+    deleteTournament()
+    deletePlayers()
+    new_t = newTournament("Wimbledon")
+
+    id1 = registerPlayer("Bruno Walton")
+    id2 = registerPlayer("Boots O'Neal")
+    if registerPlayer("bruno walton", new_t, use_existing=True) != id1:
+        raise ValueError("Registering an existing player should not add a new player.")
+    if registerPlayer("Bruno Walton", new_t, use_existing=True) != id1 or countPlayers(new_t) != 1:
+        raise ValueError("Registering an existing player twice in a tournament should do nothing.")
+    try:
+        registerPlayerInTournament(id1, new_t)
+    except IntegrityError:
+        pass
+    else:
+        raise ValueError("Registering a player twice by id should not be allowed.")
+
+    found = [row[0] for row in searchPlayers("bru")]
+    if found != [id1]:
+        raise ValueError("Players should be found by the beginning of their name.")
+    found = [row[0] for row in searchPlayers("Bruno Waltom", fuzzy=True)]
+    if not found or found[0] != id1:
+        raise ValueError("Players should be found by a similar name.")
+
+    # Duplicate of Boots O'Neal who played in another tournament
+    dup = addPlayer("Boots O'Neal")
+    registerPlayerInTournament(dup, new_t)
+    worker = reportMatch(dup, id1, tournament_id=new_t)
+    if worker is not None:
+        worker.join()
+
+    # Different players who share a name in the same tournament
+    id3 = registerPlayer("Cathy Burton", new_t)
+    id4 = registerPlayer("Cathy Burton", new_t)
+
+    if deduplicatePlayers() != [(id2, dup)]:
+        raise ValueError("Dry run should report the players that would be merged.")
+    if len(searchPlayers("Boots")) != 2:
+        raise ValueError("Dry run should not merge players.")
+
+    if deduplicatePlayers(batch_size=1, dry_run=False) != [(id2, dup)]:
+        raise ValueError("Players with the same name should be merged, unless registered in the same tournament.")
+    if [row[0] for row in searchPlayers("Cathy")] != [id3, id4]:
+        raise ValueError("Players with the same name in the same tournament should not be merged.")
+    if [row[0] for row in searchPlayers("Boots")] != [id2]:
+        raise ValueError("Merged duplicate should be deleted.")
+    standings = dict((row[0], row[2]) for row in playerStandings(new_t))
+    if standings.get(id2) != 1:
+        raise ValueError("Matches of the merged duplicate should be moved to the remaining player.")
+
+    deleteTournament()
+    print "7. Players can be searched, registered again and deduplicated."
+
 
 if __name__ == '__main__':
     print "Running regular tests..."
@@ -223,4 +347,6 @@ if __name__ == '__main__':
     testDrawMatch()
     testEqualNumberOfWins()
     testMultipleTournament()
+    testPrecomputedPairings()
+    testPlayerSearchAndDeduplication()
     print "Success!  All extra credit tests pass!"
\ No newline at end of file
@@ -6,7 +6,10 @@
 Tournament Planner: Full Stack Nano Degree Project 2
 '''
 
+import threading
+
 import psycopg2
+import psycopg2.errorcodes
 
 
 def connect(database_name="tournament"):
@@ -214,26 +217,118 @@ def addPlayer(name):
 
     return player_id
 
-def registerPlayerInTournament(player_id, tournament_id=0):
-    """Registers a player to a tournament.
+def findOrAddPlayer(name):
+    """Returns the id of an existing player with the given name (case-insensitive).
+    If there is no such player, a new one is added.
+    When several players have the same name, the one with the lowest id is returned.
 
     Args:
-      player_id:        ID of the player to be registered. The ID must be valid value returned from addPlayer().
-      tournament_id:    Optional. The id of the tournament to where to register the player.
-                        Default: 0.
+      name:  Name of the player to look up or add.
+
+    Returns:
+      ID of the existing or newly added player.
     """
 
-    query = "INSERT INTO registry (tournament_id, player_id) VALUES (%s, %s);"
+    # Serialize lookups of the same name so concurrent calls don't both add the player
+    lock_query = "SELECT pg_advisory_xact_lock(hashtext(lower(%s)));"
+    find_query = "SELECT min(id) FROM player WHERE id <> 0 AND lower(name) COLLATE \"C\" = lower(%s);"
+    add_query = "INSERT INTO player (name) VALUES (%s) RETURNING id;"
 
     conn, cur = connect()
 
-    cur.execute(query, (tournament_id, player_id))
+    cur.execute(lock_query, (name,))
+    cur.execute(find_query, (name,))
+    player_id = cur.fetchone()[0]
+
+    if player_id is None:
+        cur.execute(add_query, (name,))
+        player_id = cur.fetchone()[0]
+
     conn.commit()
 
     cur.close()
     conn.close()
 
-def registerPlayer(name, tournament_id=0):
+    return player_id
+
+def searchPlayers(name, limit=10, fuzzy=False):
+    """Searches players by name.
+
+    Args:
+      name:     The name or the beginning of the name to search for.
+      limit:    Optional. The maximum number of players to return.
+                Default: 10.
+      fuzzy:    Optional. If False, returns players whose name starts with `name` (case-insensitive),
+                sorted by lowercase name in byte order. If True, returns players with names similar to `name`,
+                most similar first.
+                Default: False.
+
+    Returns:
+      A list of tuples, each of which contains (id, name):
+        id: the player's unique id
+        name: the player's full name
+    """
+
+    if fuzzy:
+        query = "SELECT id, name FROM player WHERE id <> 0 AND name %% %s ORDER BY name <-> %s LIMIT %s;"
+        params = (name, name, limit)
+    else:
+        # Filter and order by the indexed expression, so the index returns the first rows directly
+        query = "SELECT id, name FROM player WHERE id <> 0 AND lower(name) COLLATE \"C\" LIKE lower(%s) " \
+                "ORDER BY lower(name) COLLATE \"C\", id LIMIT %s;"
+        pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        params = (pattern, limit)
+
+    conn, cur = connect()
+
+    cur.execute(query, params)
+    result = cur.fetchall()
+
+    cur.close()
+    conn.close()
+
+    return result
+
+def registerPlayerInTournament(player_id, tournament_id=0, skip_registered=False):
+    """Registers a player to a tournament.
+
+    Args:
+      player_id:        ID of the player to be registered. The ID must be valid value returned from addPlayer().
+      tournament_id:    Optional. The id of the tournament to where to register the player.
+                        Default: 0.
+      skip_registered:  Optional. If False, registering a player who is already registered
+                        in the tournament raises IntegrityError. If True, it does nothing.
+                        Default: False.
+
+    Returns:
+      True if the player was registered, False if already registered and skip_registered is True.
+    """
+
+    query = "INSERT INTO registry (tournament_id, player_id) VALUES (%(t_id)s, %(p_id)s);"
+
+    if skip_registered:
+        query = "INSERT INTO registry (tournament_id, player_id) SELECT %(t_id)s, %(p_id)s " \
+                "WHERE NOT EXISTS (SELECT 1 FROM registry WHERE tournament_id = %(t_id)s AND player_id = %(p_id)s);"
+
+    conn, cur = connect()
+
+    try:
+        cur.execute(query, {'t_id': tournament_id, 'p_id': player_id})
+        registered = cur.rowcount == 1
+        conn.commit()
+    except psycopg2.IntegrityError as e:
+        conn.rollback()
+        # With skip_registered, a concurrent call may have registered the player first
+        if not skip_registered or e.pgcode != psycopg2.errorcodes.UNIQUE_VIOLATION:
+            raise
+        registered = False
+    finally:
+        cur.close()
+        conn.close()
+
+    return registered
+
+def registerPlayer(name, tournament_id=0, use_existing=False):
     """Adds a player to the tournament database.
 
     The database assigns a unique serial id number for the player.  (This
@@ -243,9 +338,139 @@ def registerPlayer(name, tournament_id=0):
       name: the player's full name (need not be unique).
       tournament_id:    Optional. The id of the tournament to where to register the player.
                         Default: 0.
+      use_existing:     Optional. If True, registers an existing player with the same name
+                        instead of adding a new one. See findOrAddPlayer().
+                        If that player is already registered in the tournament, nothing changes,
+                        so two different players with the same name cannot be registered
+                        in one tournament this way. Use the default to add a new player.
+                        Default: False.
+
+    Returns:
+      ID of the registered player.
+    """
+
+    player_id = findOrAddPlayer(name) if use_existing else addPlayer(name)
+    registerPlayerInTournament(player_id, tournament_id, skip_registered=use_existing)
+
+    return player_id
+
+def mergePlayers(player_id, duplicate_id):
+    """Merges a duplicate player into another player.
+    Registrations and matches of the duplicate are moved to the player,
+    and the duplicate is deleted.
+
+    Args:
+      player_id:        ID of the player to keep.
+      duplicate_id:     ID of the player to merge and delete.
+
+    Returns:
+      True if merged. False if nothing was changed because either player no longer exists,
+      both players are registered in the same tournament, or a concurrent change conflicted.
+    """
+
+    if 0 in (player_id, duplicate_id):
+        raise ValueError("Cannot merge BYE player.")
+    if player_id == duplicate_id:
+        raise ValueError("Cannot merge a player with itself.")
+
+    query = "SELECT merge_player(%s, %s);"
+
+    conn, cur = connect()
+
+    cur.execute(query, (player_id, duplicate_id))
+    merged = cur.fetchone()[0]
+    conn.commit()
+
+    cur.close()
+    conn.close()
+
+    return merged
+
+def deduplicatePlayers(batch_size=100, dry_run=True):
+    """Finds players having the same name and merges them into the one with the lowest id.
+
+    WARNING: Names are the only thing compared. Any players whose names are equal
+    ignoring case are treated as the same person, unless they are registered in the
+    same tournament. Merging cannot be undone. By default nothing is merged and the
+    players that would be merged are returned for review. Reviewed pairs can also be
+    merged one by one with mergePlayers().
+
+    Players with a shared name are read one page at a time, and each merge is
+    committed on its own, so that tournaments are locked only for a single merge.
+    A merge that conflicts with a concurrent change is skipped.
+
+    Args:
+      batch_size:   Optional. The number of players read per page.
+                    Default: 100.
+      dry_run:      Optional. If True, nothing is changed and the players that would be
+                    merged are returned. Pass False to merge them.
+                    Default: True.
+
+    Returns:
+      A list of tuples, each of which contains (player_id, duplicate_id):
+        player_id: the id of the player that is kept
+        duplicate_id: the id of the player that is merged into it and deleted
     """
 
-    registerPlayerInTournament(addPlayer(name), tournament_id)
+    # Keyset pagination on the indexed (name, id) expression, reading only players with a shared name
+    page_query = "SELECT lower(name) COLLATE \"C\", id FROM player AS p " \
+                 "WHERE id <> 0 AND name IS NOT NULL {} " \
+                 "AND EXISTS (SELECT 1 FROM player AS q WHERE lower(q.name) COLLATE \"C\" = lower(p.name) " \
+                 "AND q.id <> p.id AND q.id <> 0) " \
+                 "ORDER BY 1, 2 LIMIT %s;"
+    first_page_query = page_query.format("")
+    next_page_query = page_query.format("AND (lower(name) COLLATE \"C\", id) > (%s, %s)")
+    merge_query = "SELECT merge_player(%s, %s);"
+    # Checks against the kept player and the duplicates that would already be merged into it
+    dry_run_query = "SELECT NOT EXISTS (SELECT 1 FROM registry AS a JOIN registry AS b " \
+                    "ON a.tournament_id = b.tournament_id WHERE a.player_id = ANY(%s) AND b.player_id = %s);"
+
+    merged = []
+    last_row = None
+    current_name = None
+    merged_ids = []
+
+    conn, cur = connect()
+
+    try:
+        while True:
+            if last_row is None:
+                cur.execute(first_page_query, (batch_size,))
+            else:
+                cur.execute(next_page_query, last_row + (batch_size,))
+            rows = cur.fetchall()
+            conn.commit()
+            if not rows:
+                break
+
+            for (name, duplicate_id) in rows:
+                # Rows are ordered by id, so the first player of a name is the one kept
+                if name != current_name:
+                    current_name = name
+                    merged_ids = [duplicate_id]
+                    continue
+
+                player_id = merged_ids[0]
+                if dry_run:
+                    cur.execute(dry_run_query, (merged_ids, duplicate_id))
+                else:
+                    cur.execute(merge_query, (player_id, duplicate_id))
+                result = cur.fetchone()[0]
+                conn.commit()   # Release the locks taken by this merge right away
+
+                if result:
+                    merged.append((player_id, duplicate_id))
+                    merged_ids.append(duplicate_id)
+
+            last_row = rows[-1]
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return merged
 
 def playerStandings(tournament_id=0):
     """Returns a list of the players and their win records, sorted by wins.
@@ -287,6 +512,10 @@ def reportMatch(winner, loser, isDraw=False, tournament_id=0):
       isDraw:           the match is draw
       tournament_id:    Optional. The ID of the tournament to where to report the match.
                         Default: 0.
+
+    Returns:
+      The thread precomputing the pairings for the next round if the match completed
+      the round, None otherwise.
     """
 
     query = "INSERT INTO match (tournament_id, player_id_1, player_id_2, winner) VALUES (%s, %s, %s, %s);"
@@ -296,9 +525,122 @@ def reportMatch(winner, loser, isDraw=False, tournament_id=0):
     cur.execute(query, (tournament_id, winner, loser, -1 if isDraw else winner))
     conn.commit()
 
+    round_complete = _isRoundComplete(cur, tournament_id)
+    conn.commit()
+
+    cur.close()
+    conn.close()
+
+    # Pairings for the next round can be prepared as soon as the round is over
+    if round_complete:
+        return _precomputePairingsInBackground(tournament_id)
+
+    return None
+
+def _isRoundComplete(cur, tournament_id):
+    """Checks if a round is complete using the given cursor. See isRoundComplete()."""
+
+    query = "SELECT count(DISTINCT matches) = 1 AND max(matches) > 0 FROM round_progress WHERE tournament_id = %s;"
+
+    cur.execute(query, (tournament_id,))
+
+    return bool(cur.fetchone()[0])
+
+def isRoundComplete(tournament_id=0):
+    """Returns True if every registered player has played the same number of matches.
+    Matches against the BYE player are counted. A tournament with no matches played
+    is not considered to have a completed round.
+
+    Args:
+      tournament_id:    Optional. The ID of the tournament to check.
+                        Default: 0.
+    """
+
+    conn, cur = connect()
+
+    result = _isRoundComplete(cur, tournament_id)
+    conn.commit()
+
     cur.close()
     conn.close()
 
+    return result
+
+def precomputePairings(tournament_id=0):
+    """Computes the pairings for the next round and stores them so that
+    swissPairings() can return them without evaluating the swiss_pair view.
+
+    The stored pairings are discarded if a match or registration changed
+    while they were being computed, and are invalidated by any later change.
+
+    Args:
+      tournament_id:    Optional. The ID of the tournament to compute pairings for.
+                        Default: 0.
+
+    Returns:
+      True if the pairings were stored, False otherwise.
+    """
+
+    # Version and pairings are read in a single statement so they come from the same snapshot
+    pair_query = "SELECT (SELECT version FROM pairing_state WHERE tournament_id = %s), " \
+                 "player_id_1, player_name_1, player_id_2, player_name_2 FROM swiss_pair WHERE tournament_id = %s;"
+    lock_query = "SELECT version FROM pairing_state WHERE tournament_id = %s FOR UPDATE;"
+    clear_query = "DELETE FROM pairing_cache WHERE tournament_id = %s;"
+    insert_query = "INSERT INTO pairing_cache (tournament_id, seq, player_id_1, player_name_1, player_id_2, player_name_2) " \
+                   "VALUES (%s, %s, %s, %s, %s, %s);"
+    state_query = "UPDATE pairing_state SET cached_version = %s WHERE tournament_id = %s;"
+
+    conn, cur = connect()
+
+    cur.execute(pair_query, (tournament_id, tournament_id))
+    rows = cur.fetchall()
+    conn.commit()
+
+    stored = False
+    if rows and rows[0][0] is not None:
+        version = rows[0][0]
+
+        # Store only if nothing changed since the pairings were computed
+        cur.execute(lock_query, (tournament_id,))
+        current = cur.fetchone()
+        if current and current[0] == version:
+            cur.execute(clear_query, (tournament_id,))
+            cur.executemany(insert_query,
+                [(tournament_id, seq) + tuple(row[1:]) for seq, row in enumerate(rows)])
+            cur.execute(state_query, (version, tournament_id))
+            stored = True
+
+    conn.commit()
+
+    cur.close()
+    conn.close()
+
+    return stored
+
+def _precomputePairingsInBackground(tournament_id=0):
+    """Runs precomputePairings() in a background thread.
+    The thread is not a daemon, so a script that reports the last match of a round
+    waits for the pairings to be stored before exiting.
+
+    Args:
+      tournament_id:    Optional. The ID of the tournament to compute pairings for.
+                        Default: 0.
+
+    Returns:
+      The started thread.
+    """
+
+    def worker():
+        try:
+            precomputePairings(tournament_id)
+        except psycopg2.Error:
+            pass    # Precomputing is only an optimization. swissPairings() falls back to the view.
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+
+    return thread
+
 def swissPairings(tournament_id=0):
     """Returns a list of pairs of players for the next round of a match.
 
@@ -307,6 +649,9 @@ def swissPairings(tournament_id=0):
     player with an equal or nearly-equal win record, that is, a player adjacent
     to him or her in the standings.
 
+    If the pairings were precomputed when the last round was completed and no
+    match or registration changed since, the stored pairings are returned.
+
     Args:
       tournament_id:    Optional. The ID of the tournament from where to retrieve pairings.
                         Default: 0.
@@ -319,13 +664,21 @@ def swissPairings(tournament_id=0):
         name2: the second player's name
     """
 
+    cached_query = "SELECT c.player_id_1, c.player_name_1, c.player_id_2, c.player_name_2 " \
+                   "FROM pairing_cache AS c JOIN pairing_state AS s ON c.tournament_id = s.tournament_id " \
+                   "WHERE c.tournament_id = %s AND s.cached_version = s.version ORDER BY c.seq;"
     query = "SELECT player_id_1, player_name_1, player_id_2, player_name_2 FROM swiss_pair WHERE tournament_id = %s;"
 
     conn, cur = connect()
 
-    cur.execute(query, (tournament_id,))
+    # Use pairings precomputed when the round was completed, if still valid
+    cur.execute(cached_query, (tournament_id,))
     result = cur.fetchall()
 
+    if not result:
+        cur.execute(query, (tournament_id,))
+        result = cur.fetchall()
+
     cur.close()
     conn.close()
 
@@ -18,10 +18,14 @@ CREATE DATABASE tournament;
 -- Connect to tournament database
 \c tournament;
 
+-- Trigram matching for fuzzy player name search
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 /**
   * Drop existing tables, triggers, and view if they already exists
   */
 -- Drop views first, in this order:
+-- DROP VIEW IF EXISTS round_progress;
 -- DROP VIEW IF EXISTS swiss_pair;
 -- DROP VIEW IF EXISTS player_standing;
 -- DROP VIEW IF EXISTS opponent_list;
@@ -29,8 +33,17 @@ CREATE DATABASE tournament;
 
 -- Drop triggers
 -- DROP TRIGGER IF EXISTS new_tournament ON tournament;
+-- DROP TRIGGER IF EXISTS match_changed ON match;
+-- DROP TRIGGER IF EXISTS match_truncated ON match;
+-- DROP TRIGGER IF EXISTS registry_changed ON registry;
+-- DROP TRIGGER IF EXISTS player_renamed ON player;
+
+-- Drop functions
+-- DROP FUNCTION IF EXISTS merge_player(int, int);
 
 -- Drop tables in this order:
+-- DROP TABLE IF EXISTS pairing_cache;
+-- DROP TABLE IF EXISTS pairing_state;
 -- DROP TABLE IF EXISTS match;
 -- DROP TABLE IF EXISTS registry;
 -- DROP TABLE IF EXISTS player;
@@ -63,6 +76,14 @@ CREATE TABLE player (
 	name	varchar(80)
 );
 
+-- Prefix and exact (case-insensitive) name lookup.
+-- 	"C" collation lets the index serve LIKE 'prefix%' and return rows
+--	already sorted, so only the first rows of a search are read.
+CREATE INDEX player_name_prefix ON player ((lower(name) COLLATE "C"), id);
+
+-- Fuzzy name lookup, ordered by trigram distance
+CREATE INDEX player_name_trgm ON player USING gist (name gist_trgm_ops);
+
 
 /**
   * registry table
@@ -76,6 +97,9 @@ CREATE TABLE registry (
 	PRIMARY KEY (tournament_id, player_id)
 );
 
+-- Tournaments of a player, used when a player is renamed or merged
+CREATE INDEX registry_player ON registry (player_id);
+
 
 /**
   * match table
@@ -112,6 +136,169 @@ CREATE TABLE match (
 CREATE UNIQUE INDEX unique_match
 	ON match (tournament_id, sort_array(array[player_id_1, player_id_2]));
 
+-- Matches of the second player, used by round_progress
+-- (the primary key covers the first player)
+CREATE INDEX match_player_2 ON match (tournament_id, player_id_2);
+
+
+/**
+  * pairing_state table
+  * Tracks changes to the results of each tournament.
+  *		version is bumped whenever a match or registration changes.
+  *		cached_version is the version the rows in pairing_cache
+  *		were computed from. The cache is valid only if both are equal.
+  */
+CREATE TABLE pairing_state (
+	tournament_id 	int PRIMARY KEY NOT NULL
+		REFERENCES tournament (id) ON DELETE CASCADE,
+	version 		int NOT NULL DEFAULT 0,
+	cached_version 	int NOT NULL DEFAULT -1
+);
+
+
+/**
+  * pairing_cache table
+  * Precomputed pairings for the next round of a tournament.
+  *		Rows are a snapshot of swiss_pair taken when a round is completed.
+  */
+CREATE TABLE pairing_cache (
+	tournament_id 	int NOT NULL
+		REFERENCES pairing_state (tournament_id) ON DELETE CASCADE,
+	seq 			int NOT NULL,
+	player_id_1 	int NOT NULL,
+	player_name_1 	varchar(80),
+	player_id_2 	int NOT NULL,
+	player_name_2 	varchar(80),
+	PRIMARY KEY (tournament_id, seq)
+);
+
+
+/**
+  * Invalidate cached pairings. Use as trigger for changes in match and registry tables.
+  *		NOTE: Every changed row updates the pairing_state row of its tournament,
+  *		so concurrent writes to the same tournament wait for each other to commit.
+  */
+CREATE OR REPLACE FUNCTION invalidate_pairing() RETURNS TRIGGER
+AS $invalidate_pairing$
+	BEGIN
+
+		IF TG_LEVEL = 'STATEMENT'
+		THEN
+			-- TRUNCATE: every tournament is affected
+			UPDATE pairing_state SET version = version + 1;
+			RETURN NULL;
+		END IF;
+
+		IF TG_OP = 'DELETE'
+			OR (TG_OP = 'UPDATE' AND OLD.tournament_id <> NEW.tournament_id)
+		THEN
+			UPDATE pairing_state SET version = version + 1
+				WHERE tournament_id = OLD.tournament_id;
+		END IF;
+
+		IF TG_OP <> 'DELETE'
+		THEN
+			UPDATE pairing_state SET version = version + 1
+				WHERE tournament_id = NEW.tournament_id;
+		END IF;
+
+		RETURN NULL;
+	END;
+$invalidate_pairing$ LANGUAGE plpgsql;
+
+
+-- Any change to match results or registered players makes cached pairings stale
+CREATE TRIGGER match_changed AFTER INSERT OR UPDATE OR DELETE ON match
+	FOR EACH ROW
+	EXECUTE PROCEDURE invalidate_pairing();
+
+CREATE TRIGGER match_truncated AFTER TRUNCATE ON match
+	FOR EACH STATEMENT
+	EXECUTE PROCEDURE invalidate_pairing();
+
+CREATE TRIGGER registry_changed AFTER INSERT OR UPDATE OR DELETE ON registry
+	FOR EACH ROW
+	EXECUTE PROCEDURE invalidate_pairing();
+
+
+/**
+  * Invalidate cached pairings of every tournament a player is registered in.
+  * Use as trigger for renaming a player, since cached pairings include player names.
+  */
+CREATE OR REPLACE FUNCTION invalidate_player_pairing() RETURNS TRIGGER
+AS $invalidate_player_pairing$
+	BEGIN
+
+		UPDATE pairing_state SET version = version + 1
+			WHERE tournament_id IN
+				(SELECT tournament_id FROM registry WHERE player_id = NEW.id);
+
+		RETURN NULL;
+	END;
+$invalidate_player_pairing$ LANGUAGE plpgsql;
+
+
+CREATE TRIGGER player_renamed AFTER UPDATE OF name ON player
+	FOR EACH ROW
+	WHEN (OLD.name IS DISTINCT FROM NEW.name)
+	EXECUTE PROCEDURE invalidate_player_pairing();
+
+
+/**
+  * Merge a duplicate player into another player.
+  * 	Registrations and matches of the duplicate are moved to the player
+  *		and the duplicate is deleted.
+  *	Returns TRUE if merged. Returns FALSE, changing nothing, if:
+  *		- either player no longer exists (e.g. already merged),
+  *		- both players are registered in the same tournament,
+  *		- a concurrent change conflicts with the merge.
+  */
+CREATE OR REPLACE FUNCTION merge_player(keep_id int, dup_id int) RETURNS boolean
+AS $merge_player$
+	BEGIN
+
+		-- Lock both players, in id order, so that neither can be
+		-- registered in a tournament while merging
+		IF (SELECT count(*) FROM
+				(SELECT id FROM player WHERE id IN (keep_id, dup_id) ORDER BY id FOR UPDATE) AS p) < 2
+		THEN
+			RETURN FALSE;
+		END IF;
+
+		-- Lock registrations of the duplicate, so that no match
+		-- can be reported for it while merging
+		PERFORM 1 FROM registry WHERE player_id = dup_id FOR UPDATE;
+
+		-- Players in the same tournament are different people who share a name
+		IF EXISTS (SELECT 1 FROM registry AS a JOIN registry AS b ON a.tournament_id = b.tournament_id
+			WHERE a.player_id = keep_id AND b.player_id = dup_id)
+		THEN
+			RETURN FALSE;
+		END IF;
+
+		INSERT INTO registry (tournament_id, player_id)
+			SELECT tournament_id, keep_id FROM registry WHERE player_id = dup_id;
+
+		UPDATE match SET
+			player_id_1 = (CASE WHEN player_id_1 = dup_id THEN keep_id ELSE player_id_1 END),
+			player_id_2 = (CASE WHEN player_id_2 = dup_id THEN keep_id ELSE player_id_2 END),
+			winner = (CASE WHEN winner = dup_id THEN keep_id ELSE winner END)
+		WHERE
+			tournament_id IN (SELECT tournament_id FROM registry WHERE player_id = dup_id)
+			AND (player_id_1 = dup_id OR player_id_2 = dup_id);
+
+		DELETE FROM registry WHERE player_id = dup_id;
+		DELETE FROM player WHERE id = dup_id;
+
+		RETURN FOUND;
+
+	EXCEPTION
+		-- Lost a race with a concurrent change. Nothing is merged.
+		WHEN unique_violation OR foreign_key_violation OR deadlock_detected THEN
+			RETURN FALSE;
+	END;
+$merge_player$ LANGUAGE plpgsql;
+
 
 /**
   * Create BYE player. Use as trigger for INSERT in tournament table.
@@ -133,6 +320,13 @@ AS $generate_bye_player$
 			INSERT INTO registry (tournament_id, player_id) VALUES (NEW.id, 0);
 		END IF;
 
+		-- Start tracking changes for cached pairings
+		IF NOT EXISTS (SELECT tournament_id FROM pairing_state
+			WHERE tournament_id = NEW.id)
+		THEN
+			INSERT INTO pairing_state (tournament_id) VALUES (NEW.id);
+		END IF;
+
 		RETURN NULL;
 	END;
 $generate_bye_player$ LANGUAGE plpgsql;
@@ -267,6 +461,35 @@ CREATE VIEW swiss_pair AS
 		ps1.rank % 2 = 1;
 
 
+/**
+  * Round Progress
+  * Number of matches played per player per tournament, counting the BYE.
+  * 	A round is complete when every registered player
+  *		has played the same number of matches.
+  */
+CREATE VIEW round_progress AS
+	SELECT
+		registry.tournament_id,
+		registry.player_id,
+		count(match.player_id) AS matches
+	FROM
+		registry
+		LEFT OUTER JOIN
+			(
+				-- One row per player per match, so each side can use an index
+				SELECT tournament_id, player_id_1 AS player_id FROM match
+				UNION ALL
+				SELECT tournament_id, player_id_2 AS player_id FROM match
+			) AS match
+			ON 	registry.tournament_id = match.tournament_id
+				AND registry.player_id = match.player_id
+	WHERE
+		registry.player_id <> 0
+	GROUP BY
+		registry.tournament_id,
+		registry.player_id;
+
+
 -- Create Default Tournament
 INSERT INTO tournament (id, title) VALUES (0, 'Default Tournament');
 